@@ -3,8 +3,10 @@ from __future__ import annotations
 import argparse
 import csv
 import os
+import shutil
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import takewhile
 from typing import Iterable, List, Dict, Any
 
 from loguru import logger
@@ -16,31 +18,31 @@ if CURRENT_DIR not in sys.path:
 
 try:
     from ls_t1305 import LsOpenApiT1305, write_csv
+    from rate_limiter import RateLimiter
+    from atomic_io import atomic_write
 except Exception as e:
     logger.error("Failed to import ls_api: {}", e)
     raise
 
 
 def load_tickers_from_txt(path: str) -> List[str]:
-    tickers: List[str] = []
+    # Single read + splitlines instead of per-line iteration over the text stream
     with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            t = line.strip()
-            if not t:
-                continue
-            tickers.append(t)
-    return tickers
+        lines = f.read().splitlines()
+    return [t for t in (line.strip() for line in lines) if t]
 
 
 def load_tickers_from_csv(path: str) -> List[str]:
     tickers: List[str] = []
-    with open(path, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        # Expect a 'ticker' column
-        if 'ticker' not in reader.fieldnames if reader.fieldnames else True:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        # Expect a 'ticker' column; resolve its position once instead of building a dict per row
+        if not header or 'ticker' not in header:
             raise RuntimeError("CSV must have a 'ticker' header column")
+        idx = header.index('ticker')
         for row in reader:
-            t = (row.get('ticker') or '').strip()
+            t = (row[idx] if idx < len(row) else '').strip()
             if not t:
                 continue
             tickers.append(t)
@@ -48,13 +50,39 @@ def load_tickers_from_csv(path: str) -> List[str]:
 
 
 def unique_preserve_order(items: Iterable[str]) -> List[str]:
-    seen = set()
-    out: List[str] = []
-    for x in items:
-        if x not in seen:
-            seen.add(x)
-            out.append(x)
-    return out
+    # dicts keep insertion order, so this dedups in one C-level pass
+    return list(dict.fromkeys(items))
+
+def read_last_date(path: str) -> str | None:
+    """
+    Returns the newest date stored in a descending price CSV, i.e. the date of its first data row.
+    Only the header and that one row are read, however long the history is.
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        first = next(reader, None)
+    if not header or not first or "date" not in header:
+        return None
+    idx = header.index("date")
+    return first[idx] if idx < len(first) else None
+
+
+def prepend_rows(rows: List[Dict[str, Any]], path: str) -> None:
+    """
+    Inserts rows (newest first) between the header and the existing data rows of a price CSV.
+    Existing rows are copied as raw text rather than re-parsed, and the result replaces the
+    original file atomically, so the descending layout is kept without rewriting it row by row.
+    """
+    # src is opened inside the atomic block so it is closed before the temp file replaces it
+    with atomic_write(path, encoding="utf-8", newline="", buffering=1 << 20) as dst:
+        with open(path, "r", encoding="utf-8", newline="") as src:
+            header_line = src.readline()
+            cols = next(csv.reader([header_line]))
+            dst.write(header_line)
+            csv.writer(dst).writerows([r.get(k, "") for k in cols] for r in rows)
+            shutil.copyfileobj(src, dst, 1 << 20)
+
 
 def download_year_price(
     client: LsOpenApiT1305, 
@@ -84,6 +112,64 @@ def download_year_price(
         return False
 
 
+def process_ticker(
+    client: LsOpenApiT1305,
+    t: str,
+    out_csv: str,
+    exists: bool,
+    i: int,
+    total: int,
+    args: argparse.Namespace,
+) -> bool:
+    """
+    Creates or updates the price CSV for a single ticker.
+    Returns True if successful (including skips), False otherwise.
+    """
+    # ---------------------------------------------------------
+    # UPDATE EXISTING FILE
+    # ---------------------------------------------------------
+    if exists:
+        try:
+            # 1. Read existing file to find the last date
+            # Assumes file is sorted Descending (newest first)
+            last_date = read_last_date(out_csv)
+
+            if not last_date:
+                # File exists but is empty or invalid -> Treat as fresh download
+                logger.warning("[{:04d}/{}] Existing file empty/invalid, re-downloading...", i, total)
+                return download_year_price(client, t, out_csv, args.cnt, args.dwmcode, args.exchgubun)
+
+            # 2. Fetch small buffer (e.g., 10 days) to catch missed updates (weekends/holidays)
+            # This is more robust than fetching just cnt=1
+            update_buffer_cnt = 10
+            out = client.fetch_t1305(t, cnt=update_buffer_cnt, dwmcode=args.dwmcode, exchgubun=args.exchgubun)
+            new_rows_buffer = out.get("t1305OutBlock1", []) or []
+
+            # 3. Filter for strictly new rows
+            # The buffer is newest-first like the file, so stop at the first row we already have
+            rows_to_add = list(takewhile(lambda r: (r.get("date") or "") > last_date, new_rows_buffer))
+
+            if rows_to_add:
+                # Prepend new rows; the existing history is streamed through untouched
+                prepend_rows(rows_to_add, out_csv)
+                logger.info("[{:04d}/{}] UPDATE: Added {} new row(s) (Latest: {}) -> {}",
+                            i, total, len(rows_to_add), rows_to_add[0]['date'], out_csv)
+            else:
+                logger.info("[{:04d}/{}] SKIP: Up to date (Latest: {})", i, total, last_date)
+            return True
+
+        except Exception as e:
+            logger.error("[{:04d}/{}] FAIL (Update) {}: {}", i, total, t, e)
+            return False
+
+    # ---------------------------------------------------------
+    # NEW FILE DOWNLOAD
+    # ---------------------------------------------------------
+    else:
+        logger.info("[{:04d}/{}] New file, downloading full history...", i, total)
+        return download_year_price(client, t, out_csv, args.cnt, args.dwmcode, args.exchgubun)
+
+
 def main(argv: list[str] | None = None) -> int:
     p = argparse.ArgumentParser(description="Batch fetch t1305 period prices for many tickers and save CSV snapshots.")
     p.add_argument("--tickers", default="tickers.txt", help="Path to text file with one ticker per line (default: tickers.txt)")
@@ -93,8 +179,11 @@ def main(argv: list[str] | None = None) -> int:
     p.add_argument("--exchgubun", default="K", help="Exchange code K/N/U (default K)")
     p.add_argument("--snapshot-date", default=os.environ.get("SNAPSHOT_DATE", ""), help="YYYY-MM-DD (default: env SNAPSHOT_DATE or today KST)")
     p.add_argument("--outdir", default="data/price_data", help="Output dir pattern")
-    p.add_argument("--sleep-sec", type=float, default=1.0, help="Sleep seconds between calls (rate limit)")
+    p.add_argument("--rate-per-minute", type=float, default=60.0, help="Max t1305 calls per minute shared by all workers (default 60)")
     p.add_argument("--skip-existing", action="store_true", help="Skip if CSV already exists")
+    p.add_argument("--no-fresh-skip", action="store_true", help="Update files even if already written on/after --snapshot-date (e.g. a second run the same day after market close)")
+    p.add_argument("--concurrency", type=int, default=4, help="Number of tickers fetched in parallel (default 4)")
+    p.add_argument("--max-tickers", type=int, default=None, help="Only process the first N tickers (for test runs)")
     args = p.parse_args(argv)
 
     # Determine snapshot date
@@ -107,6 +196,12 @@ def main(argv: list[str] | None = None) -> int:
         except Exception:
             from datetime import date
             snapshot_date = date.today().isoformat()
+    # Validated once up front: the freshness cutoff below is derived from it
+    from datetime import date
+    try:
+        snapshot_day = date.fromisoformat(snapshot_date)
+    except ValueError:
+        p.error(f"--snapshot-date must be YYYY-MM-DD, got {snapshot_date!r}")
     outdir = args.outdir.replace("{date}", snapshot_date)
     os.makedirs(outdir, exist_ok=True)
 
@@ -116,93 +211,67 @@ def main(argv: list[str] | None = None) -> int:
         tickers = load_tickers_from_csv(args.instruments_csv)
     else:
         tickers = load_tickers_from_txt(args.tickers)
-    tickers = unique_preserve_order([t.strip() for t in tickers if t and t.strip()])
+    tickers = unique_preserve_order(t.strip() for t in tickers if t and t.strip())
+    if args.max_tickers:
+        tickers = tickers[:args.max_tickers]
 
     if not tickers:
         logger.error("No tickers loaded. Check input file.")
         return 2
 
-    client = LsOpenApiT1305()
-    token = client.fetch_access_token()
-    logger.success("Access token acquired ({} chars)", len(token))
+    # One directory read instead of an exists() per ticker. DirEntry.stat() is still a syscall on
+    # POSIX (only Windows caches it), so it is called only for files that reach the freshness check.
+    existing = {e.name: e for e in os.scandir(outdir) if e.is_file()}
+    # Files already written on/after the snapshot date (KST midnight) are treated as current. This
+    # assumes one run per snapshot date: a run earlier that day (e.g. before market close) makes later
+    # same-day runs skip rows that exist by then, so pass --no-fresh-skip for such a rerun.
+    from datetime import datetime, time
+    from zoneinfo import ZoneInfo
+    fresh_cutoff = datetime.combine(snapshot_day, time.min, tzinfo=ZoneInfo("Asia/Seoul")).timestamp()
 
-    ok = 0
-    fail = 0
-    
-    count = 0
+    jobs = []
+    skipped = 0
+    fresh = 0
     for i, t in enumerate(tickers, 1):
-        if count == 1:
-            break
-        count += 1
-        
-        out_csv = os.path.join(outdir, f"{t}.csv")
-
-        # ---------------------------------------------------------
-        # UPDATE EXISTING FILE
-        # ---------------------------------------------------------
-        if os.path.exists(out_csv):
-            if args.skip_existing:
-                logger.info("[{:04d}/{}] Skip existing (flag set) {}", i, len(tickers), out_csv)
-                ok += 1
-                continue
-            
-            try:
-                # 1. Read existing file to find the last date
-                existing_rows = []
-                last_date = None
-                with open(out_csv, "r", encoding="utf-8") as f:
-                    reader = csv.DictReader(f)
-                    existing_rows = list(reader)
-                
-                if existing_rows:
-                    # Assumes file is sorted Descending (newest first)
-                    last_date = existing_rows[0].get("date")
-                
-                if not last_date:
-                    # File exists but is empty or invalid -> Treat as fresh download
-                    logger.warning("[{:04d}/{}] Existing file empty/invalid, re-downloading...", i, len(tickers))
-                    if download_year_price(client, t, out_csv, args.cnt, args.dwmcode, args.exchgubun):
-                        ok += 1
-                    else:
-                        fail += 1
-                    time.sleep(max(0.0, args.sleep_sec))
-                    continue
-
-                # 2. Fetch small buffer (e.g., 10 days) to catch missed updates (weekends/holidays)
-                # This is more robust than fetching just cnt=1
-                update_buffer_cnt = 10
-                out = client.fetch_t1305(t, cnt=update_buffer_cnt, dwmcode=args.dwmcode, exchgubun=args.exchgubun)
-                new_rows_buffer = out.get("t1305OutBlock1", []) or []
-
-                # 3. Filter for strictly new rows
-                rows_to_add = [r for r in new_rows_buffer if r.get("date") > last_date]
-
-                if rows_to_add:
-                    # Prepend new rows to existing rows
-                    updated_rows = rows_to_add + existing_rows
-                    write_csv(updated_rows, out_csv)
-                    logger.info("[{:04d}/{}] UPDATE: Added {} new row(s) (Latest: {}) -> {}", 
-                                i, len(tickers), len(rows_to_add), rows_to_add[0]['date'], out_csv)
-                    ok += 1
-                else:
-                    logger.info("[{:04d}/{}] SKIP: Up to date (Latest: {})", i, len(tickers), last_date)
-                    ok += 1
+        fname = f"{t}.csv"
+        exists = fname in existing
+        if exists and args.skip_existing:
+            skipped += 1
+            continue
+        st = existing[fname].stat() if exists and not args.no_fresh_skip else None
+        if st is not None and st.st_mtime >= fresh_cutoff and st.st_size > 0:
+            fresh += 1
+            continue
+        jobs.append((i, t, os.path.join(outdir, fname), exists))
 
-            except Exception as e:
-                logger.error("[{:04d}/{}] FAIL (Update) {}: {}", i, len(tickers), t, e)
-                fail += 1
-
-        # ---------------------------------------------------------
-        # NEW FILE DOWNLOAD
-        # ---------------------------------------------------------
-        else:
-            logger.info("[{:04d}/{}] New file, downloading full history...", i, len(tickers))
-            if download_year_price(client, t, out_csv, args.cnt, args.dwmcode, args.exchgubun):
-                ok += 1
-            else:
-                fail += 1
+    if skipped:
+        logger.info("Skipping {} existing file(s) (--skip-existing)", skipped)
+    if fresh:
+        logger.info("Skipping {} file(s) already updated since {}", fresh, snapshot_date)
 
-        time.sleep(max(0.0, args.sleep_sec))
+    # Skipped tickers count as successes
+    ok = skipped + fresh
+    fail = 0
+
+    if not jobs:
+        logger.success("Done. success={}, fail={}, outdir={}", ok, fail, outdir)
+        return 0
+
+    with LsOpenApiT1305(rate_limiter=RateLimiter(args.rate_per_minute)) as client:
+        token = client.fetch_access_token()
+        logger.success("Access token acquired ({} chars)", len(token))
+
+        # Requests are network-bound, so keep several tickers in flight at once.
+        with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+            futures = [
+                pool.submit(process_ticker, client, t, out_csv, exists, i, len(tickers), args)
+                for i, t, out_csv, exists in jobs
+            ]
+            for fut in as_completed(futures):
+                if fut.result():
+                    ok += 1
+                else:
+                    fail += 1
 
     logger.success("Done. success={}, fail={}, outdir={}", ok, fail, outdir)
     return 0 if fail == 0 else 1
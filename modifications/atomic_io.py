@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+import os
+from contextlib import contextmanager
+from typing import IO, Any, Iterator
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w", **open_kwargs: Any) -> Iterator[IO[Any]]:
+    """
+    Opens <path>.tmp for writing and swaps it over path with os.replace once the block exits
+    cleanly, so an interrupted run never leaves a truncated file that a rerun would treat as done.
+    On any exception (including Ctrl-C) the temp file is removed and path is left untouched.
+
+    Args:
+        path (str): Final destination of the file.
+        mode (str): Write mode passed to open() (default "w").
+        **open_kwargs: Forwarded to open(), e.g. encoding, newline, buffering.
+    """
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, mode, **open_kwargs) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
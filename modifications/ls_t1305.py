@@ -3,13 +3,19 @@ from __future__ import annotations
 import argparse
 import csv
 import os
-from typing import Any, Dict, List
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
 
 import httpx
 from loguru import logger
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 
+from atomic_io import atomic_write
+from ls_token_cache import invalidate_cached_token, load_cached_token, save_cached_token, token_cache_path
+from rate_limiter import RateLimited, RateLimiter, wait_retry_after
+
 # Load .env from project root (one level up from apps/)
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
 load_dotenv(dotenv_path=dotenv_path)
@@ -22,7 +28,7 @@ def _bool_env(name: str, default: bool = True) -> bool:
 
 
 class LsOpenApiT1305:
-    def __init__(self) -> None:
+    def __init__(self, rate_limiter: RateLimiter | None = None) -> None:
         self.base_url = os.environ.get("LS_BASE_URL", "https://openapi.ls-sec.co.kr:8080").rstrip("/")
         self.tr_path = os.environ.get("LS_TR_GATEWAY_PATH", "/stock/market-data")
         self.app_key = os.environ.get("LS_APP_KEY")
@@ -30,12 +36,37 @@ class LsOpenApiT1305:
         self.verify_ssl = _bool_env("LS_VERIFY_SSL", True)
         self.mac_address = os.environ.get("LS_MAC_ADDRESS", "")  # 법인 계정일 때만 필요
         self.mock = _bool_env("LS_MOCK", False)
+        # Tokens last for hours; reuse them across runs. Set LS_TOKEN_CACHE="" to disable.
+        self.token_cache_path = token_cache_path(self.app_key)
+        # Serializes re-authentication when several workers hit 401 with the same stale token
+        self._token_lock = threading.Lock()
 
         print("LS keys: {} {}".format(self.app_key, self.app_secret))
         if not self.mock and (not self.app_key or not self.app_secret):
             raise RuntimeError("Missing LS_APP_KEY or LS_SECRET_KEY in environment. Please set them in your .env file.")
 
         self._access_token: str | None = None
+        # Per-token header template (auth, content type, mac); _headers() only adds the TR fields
+        self._base_headers: Dict[str, str] = {}
+        # Shared across worker threads; gates every TR call (including continuation pages)
+        self.rate_limiter = rate_limiter
+        # One pooled client so keep-alive connections (and TLS sessions) are reused across calls.
+        # HTTP/2 lets the worker threads multiplex over a single connection; ALPN falls back to 1.1.
+        self._http = httpx.Client(
+            verify=self.verify_ssl,
+            timeout=30.0,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+        )
+
+    def close(self) -> None:
+        self._http.close()
+
+    def __enter__(self) -> "LsOpenApiT1305":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
 
     @retry(
         reraise=True,
@@ -47,8 +78,14 @@ class LsOpenApiT1305:
     def fetch_access_token(self) -> str:
         if self.mock:
             logger.info("[MOCK] Skipping token fetch; returning dummy token")
-            self._access_token = "MOCK_TOKEN"
+            self._set_access_token("MOCK_TOKEN")
             return self._access_token
+        if self.token_cache_path:
+            cached = load_cached_token(self.token_cache_path)
+            if cached:
+                logger.info("Reusing cached LS access token from {}", self.token_cache_path)
+                self._set_access_token(cached)
+                return cached
         url = f"{self.base_url}/oauth2/token"
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         data = {
@@ -58,36 +95,68 @@ class LsOpenApiT1305:
             "scope": "oob",
         }
         logger.info("Requesting LS access token @ {}", url)
-        with httpx.Client(verify=self.verify_ssl, timeout=10.0) as client:
-            resp = client.post(url, headers=headers, data=data)
-            resp.raise_for_status()
-            payload = resp.json()
+        resp = self._http.post(url, headers=headers, data=data, timeout=10.0)
+        resp.raise_for_status()
+        payload = resp.json()
         token = payload.get("access_token")
         if not token:
             raise RuntimeError(f"No access_token in response: {payload}")
-        self._access_token = token
+        self._set_access_token(token)
+        expires_in = float(payload.get("expires_in") or 0)
+        if self.token_cache_path and expires_in > 0:
+            save_cached_token(self.token_cache_path, token, expires_in)
         return token
 
-    def _headers(self, tr_cd: str, tr_cont: str, tr_cont_key: str) -> Dict[str, str]:
-        if not self._access_token:
-            raise RuntimeError("Access token not fetched. Call fetch_access_token() first.")
-        headers = {
-            "Authorization": f"Bearer {self._access_token}",
+    def _set_access_token(self, token: str) -> None:
+        self._access_token = token
+        self._base_headers = {
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json; charset=utf-8",
-            "tr_cd": tr_cd,
-            "tr_cont": tr_cont,
-            "tr_cont_key": tr_cont_key,
         }
         if self.mac_address:
-            headers["mac_address"] = self.mac_address
+            self._base_headers["mac_address"] = self.mac_address
+
+    def _headers(self, tr_cd: str, tr_cont: str, tr_cont_key: str) -> Dict[str, str]:
+        if not self._access_token:
+            raise RuntimeError("Access token not fetched. Call fetch_access_token() first.")
+        headers = self._base_headers.copy()
+        headers["tr_cd"] = tr_cd
+        headers["tr_cont"] = tr_cont
+        headers["tr_cont_key"] = tr_cont_key
         return headers
 
+    def _refresh_access_token(self, rejected_auth: str) -> None:
+        with self._token_lock:
+            if self._access_token and f"Bearer {self._access_token}" != rejected_auth:
+                return  # another worker already replaced the rejected token
+            logger.warning("LS rejected the access token (401); fetching a new one")
+            if self.token_cache_path:
+                invalidate_cached_token(self.token_cache_path)
+            self.fetch_access_token()
+
+    @retry(
+        reraise=True,
+        stop=stop_after_attempt(5),
+        wait=wait_retry_after,
+        retry=retry_if_exception_type((httpx.TransportError, RateLimited)),
+    )
     def _tr_post(self, tr_cd: str, body: Dict[str, Any], tr_cont: str = "N", tr_cont_key: str = "") -> httpx.Response:
         url = f"{self.base_url}{self.tr_path}"
         headers = self._headers(tr_cd, tr_cont, tr_cont_key)
-        with httpx.Client(verify=self.verify_ssl, timeout=30.0) as client:
-            resp = client.post(url, headers=headers, json=body)
-            return resp
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        resp = self._http.post(url, headers=headers, json=body)
+        if resp.status_code == 401:
+            # A cached token can be revoked before its expiry; re-authenticate once and resend
+            self._refresh_access_token(headers["Authorization"])
+            headers = self._headers(tr_cd, tr_cont, tr_cont_key)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            resp = self._http.post(url, headers=headers, json=body)
+        # Throttling is transient: back off and retry instead of failing the ticker
+        if resp.status_code == 429:
+            raise RateLimited.from_response(resp)
+        return resp
 
     def fetch_t1305(self, shcode: str, cnt: int = 120, dwmcode: int = 1, exchgubun: str = "K") -> Dict[str, Any]:
         if self.mock:
@@ -144,8 +213,9 @@ class LsOpenApiT1305:
 
             data = resp.json()
 
-            h_tr_cont = resp.headers.get("tr_cont") or resp.headers.get("Tr-Cont") or resp.headers.get("TR_CONT")
-            h_tr_cont_key = resp.headers.get("tr_cont_key") or resp.headers.get("Tr-Cont-Key") or resp.headers.get("TR_CONT_KEY") or ""
+            # httpx.Headers lookups are case-insensitive; only the hyphenated spelling needs a fallback
+            h_tr_cont = resp.headers.get("tr_cont") or resp.headers.get("tr-cont", "")
+            h_tr_cont_key = resp.headers.get("tr_cont_key") or resp.headers.get("tr-cont-key", "")
 
             if data.get("rsp_cd") and data["rsp_cd"] != "00000":
                 msg = data.get("rsp_msg", "unknown error")
@@ -157,7 +227,7 @@ class LsOpenApiT1305:
             if isinstance(rows, list):
                 total_rows.extend(rows)
 
-            logger.info("Fetched batch: {} rows (accum={}/{})", len(rows), len(total_rows), cnt)
+            logger.info("Fetched batch: {} rows (accum={}/{}) via {}", len(rows), len(total_rows), cnt, resp.http_version)
 
             if len(total_rows) >= cnt:
                 tr_cont = "N"
@@ -180,31 +250,41 @@ class LsOpenApiT1305:
         }
 
 
+PREFERRED_COLUMNS = (
+    "date",
+    "open",
+    "high",
+    "low",
+    "close",
+    "volume",
+    "value",
+    "diff",
+    "change",
+    "sign",
+    "shcode",
+    "marketcap",
+)
+
+
+@lru_cache(maxsize=32)
+def _columns_for_keys(keys: Tuple[str, ...]) -> Tuple[str, ...]:
+    # t1305 returns the same key set for every ticker, so this resolves once per batch
+    return tuple(c for c in PREFERRED_COLUMNS if c in keys) + tuple(c for c in keys if c not in PREFERRED_COLUMNS)
+
+
 def write_csv(rows: List[Dict[str, Any]], path: str) -> None:
+    """
+    Writes t1305 rows to CSV. The header is resolved once per key set via _columns_for_keys.
+    """
     if not rows:
         open(path, "w").close()
         return
-    preferred = [
-        "date",
-        "open",
-        "high",
-        "low",
-        "close",
-        "volume",
-        "value",
-        "diff",
-        "change",
-        "sign",
-        "shcode",
-        "marketcap",
-    ]
-    cols = [c for c in preferred if c in rows[0]] + [c for c in rows[0].keys() if c not in preferred]
+    cols = _columns_for_keys(tuple(rows[0].keys()))
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=cols)
-        w.writeheader()
-        for r in rows:
-            w.writerow({k: r.get(k, "") for k in cols})
+    with atomic_write(path, newline="", encoding="utf-8", buffering=1 << 20) as f:
+        w = csv.writer(f)
+        w.writerow(cols)
+        w.writerows([r.get(k, "") for k in cols] for r in rows)
 
 
 def main(argv: list[str] | None = None) -> int:
@@ -219,11 +299,11 @@ def main(argv: list[str] | None = None) -> int:
     p.add_argument("--csv", default="", help="Output CSV path (optional)")
     args = p.parse_args(argv)
 
-    client = LsOpenApiT1305()
-    token = client.fetch_access_token()
-    logger.success("Access token acquired ({} chars)", len(token))
+    with LsOpenApiT1305() as client:
+        token = client.fetch_access_token()
+        logger.success("Access token acquired ({} chars)", len(token))
 
-    out = client.fetch_t1305(args.shcode, cnt=args.cnt, dwmcode=args.dwmcode, exchgubun=args.exchgubun)
+        out = client.fetch_t1305(args.shcode, cnt=args.cnt, dwmcode=args.dwmcode, exchgubun=args.exchgubun)
     rows = out.get("t1305OutBlock1", [])
     logger.success("Fetched {} rows", len(rows))
 
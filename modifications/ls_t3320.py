@@ -4,6 +4,7 @@ import argparse
 import csv
 import os
 import sys
+import threading
 from typing import Any, Dict, List
 
 import httpx
@@ -11,6 +12,10 @@ from loguru import logger
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 
+from atomic_io import atomic_write
+from ls_token_cache import invalidate_cached_token, load_cached_token, save_cached_token, token_cache_path
+from rate_limiter import RateLimited, RateLimiter, wait_retry_after
+
 # Load .env from project root
 # Ensure we can find the .env file regardless of where this script is run
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -26,7 +31,7 @@ def _bool_env(name: str, default: bool = True) -> bool:
 
 
 class LsOpenApiT3320:
-    def __init__(self) -> None:
+    def __init__(self, rate_limiter: RateLimiter | None = None) -> None:
         self.base_url = os.environ.get("LS_BASE_URL", "https://openapi.ls-sec.co.kr:8080").rstrip("/")
         self.tr_path = os.environ.get("LS_TR_GATEWAY_PATH", "/stock/investinfo")
         self.app_key = os.environ.get("LS_APP_KEY")
@@ -39,6 +44,30 @@ class LsOpenApiT3320:
             logger.warning("LS_APP_KEY or LS_SECRET_KEY not found in environment.")
 
         self._access_token: str | None = None
+        # Per-token header template (auth, content type, mac); _headers() only adds the TR fields
+        self._base_headers: Dict[str, str] = {}
+        # Shared with LsOpenApiT1305, so a token from either script is reused by the other
+        self.token_cache_path = token_cache_path(self.app_key)
+        # Serializes re-authentication when several workers hit 401 with the same stale token
+        self._token_lock = threading.Lock()
+        # Optional shared token bucket; batch callers pass one so parallel workers stay under the TR quota
+        self.rate_limiter = rate_limiter
+        # One pooled client so keep-alive connections (and TLS sessions) are reused across calls
+        self._http = httpx.Client(
+            verify=self.verify_ssl,
+            timeout=30.0,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+        )
+
+    def close(self) -> None:
+        self._http.close()
+
+    def __enter__(self) -> "LsOpenApiT3320":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
 
     @retry(
         reraise=True,
@@ -48,8 +77,14 @@ class LsOpenApiT3320:
     )
     def fetch_access_token(self) -> str:
         if self.mock:
-            self._access_token = "MOCK_TOKEN"
+            self._set_access_token("MOCK_TOKEN")
             return self._access_token
+        if self.token_cache_path:
+            cached = load_cached_token(self.token_cache_path)
+            if cached:
+                logger.info("Reusing cached LS access token from {}", self.token_cache_path)
+                self._set_access_token(cached)
+                return cached
         
         url = f"{self.base_url}/oauth2/token"
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
@@ -60,37 +95,69 @@ class LsOpenApiT3320:
             "scope": "oob",
         }
         
-        with httpx.Client(verify=self.verify_ssl, timeout=10.0) as client:
-            resp = client.post(url, headers=headers, data=data)
-            resp.raise_for_status()
-            payload = resp.json()
+        resp = self._http.post(url, headers=headers, data=data, timeout=10.0)
+        resp.raise_for_status()
+        payload = resp.json()
         
         token = payload.get("access_token")
         if not token:
             raise RuntimeError(f"No access_token in response: {payload}")
-        self._access_token = token
+        self._set_access_token(token)
+        expires_in = float(payload.get("expires_in") or 0)
+        if self.token_cache_path and expires_in > 0:
+            save_cached_token(self.token_cache_path, token, expires_in)
         return token
 
-    def _headers(self, tr_cd: str, tr_cont: str, tr_cont_key: str) -> Dict[str, str]:
-        if not self._access_token:
-            raise RuntimeError("Access token not fetched. Call fetch_access_token() first.")
-        headers = {
-            "Authorization": f"Bearer {self._access_token}",
+    def _set_access_token(self, token: str) -> None:
+        self._access_token = token
+        self._base_headers = {
+            "Authorization": f"Bearer {token}",
             "Content-Type": "application/json; charset=utf-8",
-            "tr_cd": tr_cd,
-            "tr_cont": tr_cont,
-            "tr_cont_key": tr_cont_key,
         }
         if self.mac_address:
-            headers["mac_address"] = self.mac_address
+            self._base_headers["mac_address"] = self.mac_address
+
+    def _headers(self, tr_cd: str, tr_cont: str, tr_cont_key: str) -> Dict[str, str]:
+        if not self._access_token:
+            raise RuntimeError("Access token not fetched. Call fetch_access_token() first.")
+        headers = self._base_headers.copy()
+        headers["tr_cd"] = tr_cd
+        headers["tr_cont"] = tr_cont
+        headers["tr_cont_key"] = tr_cont_key
         return headers
 
+    def _refresh_access_token(self, rejected_auth: str) -> None:
+        with self._token_lock:
+            if self._access_token and f"Bearer {self._access_token}" != rejected_auth:
+                return  # another worker already replaced the rejected token
+            logger.warning("LS rejected the access token (401); fetching a new one")
+            if self.token_cache_path:
+                invalidate_cached_token(self.token_cache_path)
+            self.fetch_access_token()
+
+    @retry(
+        reraise=True,
+        stop=stop_after_attempt(5),
+        wait=wait_retry_after,
+        retry=retry_if_exception_type((httpx.TransportError, RateLimited)),
+    )
     def _tr_post(self, tr_cd: str, body: Dict[str, Any], tr_cont: str = "N", tr_cont_key: str = "") -> httpx.Response:
         url = f"{self.base_url}{self.tr_path}"
         headers = self._headers(tr_cd, tr_cont, tr_cont_key)
-        with httpx.Client(verify=self.verify_ssl, timeout=30.0) as client:
-            resp = client.post(url, headers=headers, json=body)
-            return resp
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        resp = self._http.post(url, headers=headers, json=body)
+        if resp.status_code == 401:
+            # A cached token can be revoked before its expiry; re-authenticate once and resend
+            self._refresh_access_token(headers["Authorization"])
+            headers = self._headers(tr_cd, tr_cont, tr_cont_key)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            resp = self._http.post(url, headers=headers, json=body)
+        # Throttling is transient: back off and retry instead of failing the ticker
+        if resp.status_code == 429:
+            raise RateLimited.from_response(resp)
+        return resp
 
     def fetch_t3320(self, gicode: str) -> Dict[str, Any]:
         """
@@ -145,6 +212,18 @@ class LsOpenApiT3320:
         return data
 
 
+# Preferred column order for Company Info
+PREFERRED_COLUMNS = (
+    "company", "gicode", "price", "marketnm", "upgubunnm", # Basic Identity
+    "per", "pbr", "roe", "roa", "eps", "bps", "sps", "cps", # Valuation
+    "ebitda", "evebitda", "peg", "sales", "operatingincome", # Financials
+    "foreignratio", "cashrate", "capital", "sigavalue", # Stats
+    "gsyyyy", "gsmm", "gsym", # Fiscal Date
+    "baddress", "irtel", "homeurl" # Contact
+)
+_PREFERRED_SET = frozenset(PREFERRED_COLUMNS)
+
+
 def write_csv(rows: List[Dict[str, Any]], path: str) -> None:
     """
     Writes a list of dictionaries to a CSV file.
@@ -154,27 +233,17 @@ def write_csv(rows: List[Dict[str, Any]], path: str) -> None:
         open(path, "w").close()
         return
     
-    # Preferred column order for Company Info
-    preferred = [
-        "company", "gicode", "price", "marketnm", "upgubunnm", # Basic Identity
-        "per", "pbr", "roe", "roa", "eps", "bps", "sps", "cps", # Valuation
-        "ebitda", "evebitda", "peg", "sales", "operatingincome", # Financials
-        "foreignratio", "cashrate", "capital", "sigavalue", # Stats
-        "gsyyyy", "gsmm", "gsym", # Fiscal Date
-        "baddress", "irtel", "homeurl" # Contact
-    ]
-    
     # Get all keys from the first row
     first_row_keys = rows[0].keys()
     # Sort keys: preferred first, then alphabetical rest
-    cols = [c for c in preferred if c in first_row_keys] + sorted([c for c in first_row_keys if c not in preferred])
+    present = first_row_keys & _PREFERRED_SET
+    cols = [c for c in PREFERRED_COLUMNS if c in present] + sorted(first_row_keys - _PREFERRED_SET)
     
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=cols)
-        w.writeheader()
-        for r in rows:
-            w.writerow({k: r.get(k, "") for k in cols})
+    with atomic_write(path, newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(cols)
+        w.writerows([r.get(k, "") for k in cols] for r in rows)
 
 
 def main(argv: list[str] | None = None) -> int:
@@ -187,11 +256,11 @@ def main(argv: list[str] | None = None) -> int:
     args = p.parse_args(argv)
 
     try:
-        client = LsOpenApiT3320()
-        token = client.fetch_access_token()
-        logger.success("Access token acquired ({} chars)", len(token))
+        with LsOpenApiT3320() as client:
+            token = client.fetch_access_token()
+            logger.success("Access token acquired ({} chars)", len(token))
 
-        out = client.fetch_t3320(gicode=args.gicode)
+            out = client.fetch_t3320(gicode=args.gicode)
         
         # t3320 returns two separate blocks for one company.
         # We merge them into a single dictionary for easier usage/CSV saving.
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+
+from loguru import logger
+
+
+def token_cache_path(app_key: str | None) -> str:
+    """
+    Returns the on-disk token cache shared by all LS Open API clients (t1305, t3320, ...).
+    Tokens are issued per app key, not per TR, so one file per key serves every client;
+    the key is hashed into the file name so several accounts never overwrite each other.
+    Set LS_TOKEN_CACHE to a file path to override, or to "" to disable caching.
+    """
+    override = os.environ.get("LS_TOKEN_CACHE")
+    if override is not None:
+        return os.path.expanduser(override)
+    digest = hashlib.sha256((app_key or "").encode("utf-8")).hexdigest()[:16]
+    return os.path.expanduser(f"~/.cache/ls-api/token-{digest}.json")
+
+
+def load_cached_token(path: str) -> str | None:
+    """Returns the cached access token if it stays valid for at least another minute."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        if float(cache.get("expires_at", 0)) - 60 > time.time():
+            return cache.get("access_token") or None
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def save_cached_token(path: str, token: str, expires_in: float) -> None:
+    try:
+        # A bare file name (LS_TOKEN_CACHE=token.json) has no directory part to create
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        # Created 0600 up front so the token is never world-readable, then swapped in atomically
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"access_token": token, "expires_at": time.time() + expires_in}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("Could not persist LS access token to {}: {}", path, e)
+
+
+def invalidate_cached_token(path: str) -> None:
+    """Drops a cached token the server has rejected, so the next fetch goes to /oauth2/token."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Could not remove stale LS access token {}: {}", path, e)
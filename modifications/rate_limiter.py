@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any
+
+from tenacity import RetryCallState, wait_exponential_jitter
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket shared by all workers of a batch.
+
+    Callers block in acquire() only when the bucket is empty, so skipped
+    tickers and slow responses no longer pay a fixed sleep.
+
+    Args:
+        rate_per_minute (float): Sustained number of calls allowed per minute.
+            A value <= 0 disables limiting.
+        burst (int): Number of calls that may go out back-to-back when idle.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int = 1) -> None:
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) / self.interval)
+            self._last = now
+            # Reserve a token up front; a negative balance is the queue of waiters ahead of us.
+            self._tokens -= 1
+            wait = -self._tokens * self.interval if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimited(Exception):
+    """
+    Raised when the server answers HTTP 429.
+
+    Args:
+        retry_after (float): Seconds the server asked us to wait (0 if it did not say).
+    """
+
+    def __init__(self, retry_after: float = 0.0) -> None:
+        super().__init__(f"rate limited (retry after {retry_after:g}s)")
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, resp: Any) -> "RateLimited":
+        try:
+            retry_after = float(resp.headers.get("Retry-After", 0))
+        except ValueError:
+            # HTTP-date form; fall back to plain backoff
+            retry_after = 0.0
+        return cls(max(0.0, retry_after))
+
+
+_jitter_backoff = wait_exponential_jitter(initial=1, max=30)
+
+
+def wait_retry_after(retry_state: RetryCallState) -> float:
+    """tenacity wait: exponential backoff with jitter, but never shorter than the server's Retry-After."""
+    backoff = _jitter_backoff(retry_state)
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    if isinstance(exc, RateLimited):
+        return max(backoff, exc.retry_after)
+    return backoff
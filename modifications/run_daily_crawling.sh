@@ -34,7 +34,7 @@ echo "[Step 1/3] Collecting Financial Data (t3320)..."
 $PY modifications/append_financial_data.py \
     --tickers tickers.txt \
     --outdir data/financial_data \
-    --sleep-sec 1.1
+    --rate-per-minute 54
 echo "[Step 1/3] Done."
 
 # 3. Run Stock Price Collection
@@ -45,7 +45,7 @@ $PY modifications/append_stock_prices.py \
     --tickers tickers.txt \
     --outdir data/price_data \
     --snapshot-date "$SNAPSHOT_DATE" \
-    --sleep-sec 1.0
+    --rate-per-minute 60
 echo "[Step 2/3] Done."
 
 # 4. Run News Crawling
@@ -58,7 +58,7 @@ $PY modifications/news_naver.py \
     --outdir "data/news_naver/{date}" \
     --days 1 \
     --per-query 20 \
-    --sleep-sec 0.2
+    --rate-per-minute 600
 echo "[Step 3/3] Done."
 
 echo "============================================================"